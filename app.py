@@ -1,137 +1,277 @@
 import fitz
-import base64
-import io
+import pybase64
+import simplejpeg
+import numpy as np
 from PIL import Image
+import io
 import traceback
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, stream_with_context
 import os
 import gc
-import psutil
-from typing import Optional, Tuple, Dict
-from dataclasses import dataclass
+from typing import Optional, Tuple, Dict, Iterator, List
+from dataclasses import dataclass, replace
 import logging
-import mmap
-import resource
-import sys
+import math
+import multiprocessing
+import orjson
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import count, islice
+
+# Served by gunicorn (see gunicorn.conf.py); run locally with `flask --app app run`
+class SpoolToDiskRequest(Request):
+    """Request that writes file uploads straight into named temp files.
+
+    Werkzeug's default spools them in memory or an anonymous file, which then
+    has to be copied out before MuPDF and the render workers can open it by
+    path. The files are deleted when the request closes.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile(suffix=".pdf")
 
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 31457280  # 30MB
+app.request_class = SpoolToDiskRequest
+MAX_UPLOAD_MB = 30
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
 
-logging.basicConfig(level=logging.INFO)
+# LOG_LEVEL=DEBUG also turns on per-page memory logging
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
+# Reports the SIMD kernel picked at import, e.g. "(C extension active - AVX512VBMI)"
+logger.info(f"pybase64 {pybase64.get_version()}")
 
-@dataclass
+SUPPORTED_FORMATS = {"AUTO", "JPEG", "PNG", "WEBP"}
+FORMAT_ALIASES = {"JPG": "JPEG"}
+# Bounds for ?dpi=; pixel count grows with its square, so cap it against OOM
+MIN_DPI, MAX_DPI = 72, 400
+# Pixel budget for one render (~48MB as RGB); fits a Letter or A4 page at MAX_DPI
+MAX_RENDER_PIXELS = 16 * 1024 * 1024
+# Above this many pixels JPEG/WebP quality drops a step to keep responses in check
+LARGE_RENDER_PIXELS = 8 * 1024 * 1024
+# A page is treated as line art, and saved as PNG, when its few most common
+# colours cover at least this share of it
+LINE_ART_TOP_COLOURS = 8
+LINE_ART_MIN_SHARE = 0.8
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+# Like Acrobat, accept the header anywhere in the first 1KB, after any leading junk
+PDF_MAGIC, PDF_HEADER_SEARCH = b"%PDF-", 1024
+BASE64_CHUNK_SIZE = 3 << 18  # 768KB; a multiple of 3 so chunks encode without padding
+# Full collections walk the whole heap and stall the request; when chasing leaks,
+# set GC_EVERY_REQUESTS=N to run one every N requests (0 leaves it to CPython)
+GC_EVERY_REQUESTS = int(os.environ.get("GC_EVERY_REQUESTS", 0))
+# Render processes per gunicorn worker. By default the cores are split between
+# the workers (WEB_CONCURRENCY, defaulting as in gunicorn.conf.py), which leaves
+# one, i.e. in-process rendering, unless there are more cores than workers
+WEB_WORKERS = int(os.environ.get("WEB_CONCURRENCY", min(os.cpu_count() or 1, 4)))
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+# Parsed documents each render process keeps open; they only serve the pages of
+# requests in flight, so a couple is enough
+RENDER_PROCESS_DOCUMENTS = 2
+# Pages each render process serves before it is replaced, bounding what it can
+# leak or hold on to (including deleted uploads kept open by its document_cache)
+RENDER_PROCESS_MAX_PAGES = int(os.environ.get("RENDER_PROCESS_MAX_PAGES", 100))
+# Pages a request keeps queued or rendered ahead of what it has sent; enough
+# to keep every render process busy while the client reads
+RENDER_WINDOW = 2 * PDF_WORKERS
+# Per-worker budget for rendered page images kept for repeat requests
+RENDER_CACHE_MB = int(os.environ.get("RENDER_CACHE_MB", 64))
+
+@dataclass(frozen=True)
 class QualitySettings:
     dpi: int = 150  # Reduced default DPI
-    format: str = "JPEG"
-    max_dimension: int = 1800  # Reduced max dimension
+    format: str = "AUTO"  # JPEG, or PNG for line-art pages; WEBP on request
+    max_dimension: int = 1800  # Longest side at the default dpi; grows in step with dpi
     quality: int = 75  # Lower default quality
-    optimize: bool = True
-
-    def adjust_for_page_size(self, page_size_mb: float) -> None:
-        if page_size_mb > 15:  # Very large page
-            self.dpi = 125
-            self.quality = 70
-            self.max_dimension = 1600
-        elif page_size_mb > 8:  # Large page
-            self.dpi = 150
-            self.quality = 75
-            self.max_dimension = 1800
-
-def limit_memory(max_mem_mb: int = 512) -> None:
-    """Set memory limits for the process"""
-    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
-    resource.setrlimit(resource.RLIMIT_AS, (max_mem_mb * 1024 * 1024, hard))
+    snap_zoom: bool = True  # Round down to a whole zoom within 5%; 150 DPI renders at 144
+    grayscale: bool = False  # One byte per pixel instead of three
+
+    @property
+    def zoom(self) -> float:
+        """Render zoom factor; whole numbers keep MuPDF on its faster integer scaling path"""
+        zoom = self.dpi / 72
+        # Only round down, and only by a little, so a higher dpi never renders smaller
+        if self.snap_zoom and zoom - int(zoom) <= 0.05 * int(zoom):
+            return int(zoom)
+        return zoom
+
+    def render_scale(self, width: float, height: float) -> float:
+        """Scale to render a width x height point page at.
+
+        The requested zoom, capped so the longest side stays within max_dimension
+        (scaled to the requested dpi, i.e. 12in at any dpi) and the page within
+        MAX_RENDER_PIXELS. Each bound is fixed or grows with dpi, so the output
+        never shrinks as dpi rises.
+        """
+        max_dimension = self.max_dimension * self.dpi / QualitySettings.dpi
+        return min(self.zoom, max_dimension / max(width, height),
+                   math.sqrt(MAX_RENDER_PIXELS / (width * height)))
+
+    def adjust_for_render_size(self, pixels: float) -> "QualitySettings":
+        """Lower the encode quality for renders too large to send at full quality"""
+        if pixels > LARGE_RENDER_PIXELS:
+            return replace(self, quality=min(self.quality, 70))
+        return self
+
+class DocumentCache:
+    """LRU of parsed documents keyed by upload digest.
+
+    Spares clients fetching pages one by one from re-parsing the PDF on every
+    request. Documents stay open after their temp file is unlinked, so evicted
+    entries are closed explicitly. Hold `lock` while using a cached document.
+    """
+
+    def __init__(self, max_documents: int = 8):
+        self.max_documents = max_documents
+        self.lock = threading.RLock()
+        self._documents: "OrderedDict[str, fitz.Document]" = OrderedDict()
+
+    def get(self, digest: str, pdf_path: str) -> fitz.Document:
+        doc = self._documents.get(digest)
+        if doc is not None:
+            self._documents.move_to_end(digest)
+            logger.info(f"Document cache hit for {digest}")
+            return doc
+        
+        doc = fitz.open(pdf_path, filetype="pdf")
+        self._documents[digest] = doc
+        while len(self._documents) > self.max_documents:
+            _, evicted = self._documents.popitem(last=False)
+            evicted.close()
+        return doc
+
+    def page_count(self, digest: str, pdf_path: str) -> int:
+        with self.lock:
+            return len(self.get(digest, pdf_path))
+
+document_cache = DocumentCache()
+
+class RenderCache:
+    """LRU of rendered pages keyed by ETag, bounded by total image bytes.
+
+    Preview pagers poll the same page of the same PDF repeatedly; a hit skips
+    the render and encode entirely. Entries hold raw image bytes and are shared,
+    so callers must not mutate them.
+    """
+
+    def __init__(self, max_bytes: int = RENDER_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pages: "OrderedDict[str, Dict]" = OrderedDict()
+
+    def get(self, etag: str) -> Optional[Dict]:
+        with self._lock:
+            result = self._pages.get(etag)
+            if result is not None:
+                self._pages.move_to_end(etag)
+                logger.info(f"Render cache hit for {etag}")
+            return result
+
+    def put(self, etag: str, result: Dict) -> None:
+        size = len(result["image"])
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            previous = self._pages.pop(etag, None)
+            if previous is not None:
+                self._size -= len(previous["image"])
+            self._pages[etag] = result
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self._size -= len(evicted["image"])
+
+render_cache = RenderCache()
 
 def get_memory_usage_mb() -> float:
+    import psutil  # Only needed for debug logging, so kept out of worker startup
+    
     process = psutil.Process(os.getpid())
     mem = process.memory_info().rss / 1024 / 1024
-    logger.info(f"Current memory usage: {mem:.1f}MB")
+    logger.debug(f"Current memory usage: {mem:.1f}MB")
     return mem
 
+_requests_served = count(1)
+
 def force_cleanup() -> None:
-    """Aggressive memory cleanup"""
-    gc.collect()
-    
-    # Clear PIL's internal cache
-    Image.preinit()
-    
-    if hasattr(sys, 'exc_clear'):
-        sys.exc_clear()
+    """End-of-request cleanup; only collects when GC_EVERY_REQUESTS asks for it"""
+    if GC_EVERY_REQUESTS and next(_requests_served) % GC_EVERY_REQUESTS == 0:
+        gc.collect()
+
+def is_line_art(samples: np.ndarray) -> bool:
+    """Text and vector drawings stay sharper, and usually smaller, as PNG than JPEG.
+
+    They are drawn in a handful of flat colours with anti-aliased edges in
+    between, while photos spread over thousands of colours.
+    """
+    # Every 4th pixel in each direction, one integer per colour (0xRRGGBB or the grey level)
+    pixels = samples[::4, ::4].reshape(-1, samples.shape[2]).astype(np.uint32)
+    colours = pixels @ (np.uint32(256) ** np.arange(pixels.shape[1], dtype=np.uint32))
+    counts = np.unique(colours, return_counts=True)[1]
+    top = np.sort(counts)[-LINE_ART_TOP_COLOURS:]
+    return top.sum() >= LINE_ART_MIN_SHARE * len(colours)
+
+def process_page_to_image(page: fitz.Page, settings: QualitySettings, scale: float) -> Tuple[bytes, int, int, str]:
+    """Render PDF page to encoded image bytes at the given scale"""
+    # Bind settings once instead of re-reading dataclass attributes below
+    fmt, quality = settings.format, settings.quality
     
-    # Try to release memory back to OS
     try:
-        import ctypes
-        libc = ctypes.CDLL('libc.so.6')
-        libc.malloc_trim(0)
-    except:
-        pass
-
-def process_image_chunk(img: Image.Image, max_chunk_size: int = 1024) -> Image.Image:
-    """Process image in chunks to reduce memory usage"""
-    width, height = img.size
-    if width <= max_chunk_size and height <= max_chunk_size:
-        return img
-
-    # Process image in chunks
-    new_img = Image.new(img.mode, img.size)
-    for y in range(0, height, max_chunk_size):
-        for x in range(0, width, max_chunk_size):
-            box = (x, y, min(x + max_chunk_size, width), min(y + max_chunk_size, height))
-            chunk = img.crop(box)
-            new_img.paste(chunk, box)
-            del chunk
-            force_cleanup()
-    return new_img
-
-def process_page_to_image(page: fitz.Page, settings: QualitySettings) -> Tuple[Image.Image, int, int]:
-    """Convert PDF page to PIL Image with memory optimization"""
-    try:
-        # Calculate scale
-        scale = settings.dpi / 72
+        # Render straight at the capped scale rather than downscaling afterwards
         matrix = fitz.Matrix(scale, scale)
         
         # Get pixmap in chunks if possible
-        pix = page.get_pixmap(matrix=matrix, alpha=False)
+        colorspace = fitz.csGRAY if settings.grayscale else fitz.csRGB
+        pix = page.get_pixmap(matrix=matrix, colorspace=colorspace, alpha=False)
         
-        # Convert to PIL Image
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        del pix
-        force_cleanup()
+        # Zero-copy view of the samples
+        samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        if fmt == "AUTO":
+            fmt = "PNG" if is_line_art(samples) else "JPEG"
         
-        # Process in chunks if large
-        if max(img.size) > settings.max_dimension:
-            # Calculate new size
-            width, height = img.size
-            ratio = settings.max_dimension / max(width, height)
-            new_size = (int(width * ratio), int(height * ratio))
-            
-            # Resize in chunks
-            img = process_image_chunk(img)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
+        if fmt == "PNG":
+            return pix.tobytes(output="png"), pix.width, pix.height, fmt
         
-        return img, *img.size
+        if fmt == "WEBP":
+            # MuPDF has no WebP writer; wrap the samples without copying and let Pillow encode
+            mode = "L" if settings.grayscale else "RGB"
+            img = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, 0, 1)
+            buffer = io.BytesIO()
+            img.save(buffer, format="WEBP", quality=quality)
+            return buffer.getvalue(), pix.width, pix.height, fmt
+        
+        # libjpeg-turbo's SIMD encoder
+        jpeg = simplejpeg.encode_jpeg(samples, quality=quality, colorspace="GRAY" if settings.grayscale else "RGB",
+                                      colorsubsampling="420")
+        return jpeg, pix.width, pix.height, fmt
         
     except Exception as e:
         logger.error(f"Error in image processing: {str(e)}")
         raise
 
-def process_single_page(pdf_data: bytes, page_num: int) -> Dict:
-    """Process a single page with optimized memory handling"""
-    start_memory = get_memory_usage_mb()
-    logger.info(f"Starting page {page_num} processing. Initial memory: {start_memory:.1f}MB")
-    
-    doc = None
-    img = None
-    buffer = None
-    settings = QualitySettings()
+def process_single_page(pdf_path: str, page_num: int, settings: QualitySettings, digest: str,
+                        encode: bool = True) -> Dict:
+    """Process a single page with optimized memory handling.
+
+    The document comes from document_cache and is left open; the caller must
+    hold document_cache.lock. With encode=False the image is returned as raw
+    bytes instead of base64.
+    """
+    # Reading RSS costs a psutil import and two /proc reads per page, so only when debugging
+    log_memory = logger.isEnabledFor(logging.DEBUG)
+    if log_memory:
+        start_memory = get_memory_usage_mb()
+        logger.debug(f"Starting page {page_num} processing. Initial memory: {start_memory:.1f}MB")
     
     try:
-        # Set memory limit for this process
-        limit_memory(512)  # 512MB limit
-        
-        # Open document
-        doc = fitz.open(stream=pdf_data, filetype="pdf")
+        doc = document_cache.get(digest, pdf_path)
         total_pages = len(doc)
         
         if page_num >= total_pages:
@@ -142,34 +282,29 @@ def process_single_page(pdf_data: bytes, page_num: int) -> Dict:
         
         # Process page
         page = doc.load_page(page_num)
-        estimated_size = (page.rect.width * page.rect.height * settings.dpi * settings.dpi) / (72 * 72 * 1024 * 1024)
-        settings.adjust_for_page_size(estimated_size)
-        
-        img, width, height = process_page_to_image(page, settings)
-        
-        # Convert to bytes
-        buffer = io.BytesIO()
-        img.save(
-            buffer,
-            format=settings.format,
-            optimize=settings.optimize,
-            quality=settings.quality
-        )
+        rect = page.rect  # Each page.rect access is a call into MuPDF
+        scale = settings.render_scale(rect.width, rect.height)
+        settings = settings.adjust_for_render_size(rect.width * rect.height * scale * scale)
         
-        img_str = base64.b64encode(buffer.getvalue()).decode()
+        img_bytes, width, height, output_format = process_page_to_image(page, settings, scale)
+        image = pybase64.b64encode_as_string(img_bytes) if encode else img_bytes
+        del img_bytes
         
         return {
-            "image": img_str,
+            "image": image,
             "total_pages": total_pages,
             "page_dimensions": {
                 "width": width,
                 "height": height
             },
             "settings_used": {
-                "dpi": settings.dpi,
-                "format": settings.format,
-                "quality": settings.quality
-            }
+                # What was rendered, after the max_dimension and pixel caps
+                "dpi": round(scale * 72),
+                "format": output_format,
+                "quality": settings.quality,
+                "grayscale": settings.grayscale
+            },
+            "mime_type": f"image/{output_format.lower()}"
         }
     
     except Exception as e:
@@ -181,58 +316,427 @@ def process_single_page(pdf_data: bytes, page_num: int) -> Dict:
         }
     
     finally:
-        if buffer:
-            buffer.close()
-        if img:
-            img.close()
-        if doc:
-            doc.close()
+        # MuPDF's resource store keeps up to 256MB of fonts/images alive; empty it per page
+        fitz.TOOLS.store_shrink(100)
+        if log_memory:
+            end_memory = get_memory_usage_mb()
+            logger.debug(f"Completed page {page_num}. Memory change: {end_memory - start_memory:.1f}MB")
+
+def init_render_process() -> None:
+    document_cache.max_documents = RENDER_PROCESS_DOCUMENTS
+
+class RenderPool:
+    """This worker's PDF_WORKERS render processes, started on first use.
+
+    The processes come from a forkserver rather than a fork of this worker,
+    whose other threads may be inside MuPDF at that moment. Each keeps its own
+    document_cache, so a document is parsed once per process rather than once
+    per page. Like gunicorn's max_requests for the workers, the processes are
+    replaced after about max_pages pages each, and after one of them dies.
+    """
+
+    def __init__(self, processes: int, max_pages: int):
+        self.processes = processes
+        self.max_tasks = processes * max_pages
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks = 0
+
+    def _replace(self) -> None:
+        if self._executor is not None:
+            # Pages already queued still render; its processes exit once they have
+            self._executor.shutdown(wait=False)
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                             initializer=init_render_process)
+        self._tasks = 0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._executor is None or self._tasks >= self.max_tasks:
+                self._replace()
+            self._tasks += 1
+            try:
+                return self._executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                # A render process died since the last page, e.g. OOM-killed
+                self._replace()
+                self._tasks += 1
+                return self._executor.submit(fn, *args, **kwargs)
+
+render_pool = RenderPool(PDF_WORKERS, RENDER_PROCESS_MAX_PAGES)
+
+def render_cached_page(pdf_path: str, page_num: int, settings: QualitySettings, digest: str) -> Dict:
+    """process_single_page through this process's document_cache"""
+    # Taken per page so a slow reader doesn't block other requests' renders
+    with document_cache.lock:
+        return process_single_page(pdf_path, page_num, settings, digest)
+
+def render_pages(pdf_path: str, digest: str, page_nums: List[int],
+                 settings: QualitySettings) -> Iterator[Dict]:
+    """Render pages in order, spread over the worker's render pool.
+
+    A single page renders in this process, where a round trip through the
+    pool would cost more than it saves. Otherwise a page is only submitted
+    once an earlier one has been taken, so a slow client holds back rendering
+    instead of piling up finished pages.
+    """
+    if PDF_WORKERS == 1 or len(page_nums) == 1:
+        for page_num in page_nums:
+            yield render_cached_page(pdf_path, page_num, settings, digest)
+        return
+    
+    # Processes rather than threads: MuPDF is not thread-safe and renders hold the GIL
+    logger.info(f"Rendering {len(page_nums)} pages on {PDF_WORKERS} processes")
+    
+    # Pool processes open the spooled file by path, so no PDF bytes are pickled
+    submit = partial(render_pool.submit, render_cached_page, pdf_path, settings=settings, digest=digest)
+    remaining = iter(page_nums)
+    pending = deque(submit(page_num) for page_num in islice(remaining, RENDER_WINDOW))
+    try:
+        while pending:
+            try:
+                result = pending.popleft().result()
+            except BrokenProcessPool as e:
+                # Headers are already sent, so fail this and the remaining pages in the body
+                logger.error(f"Render process died: {e}")
+                failed = 1 + len(pending) + sum(1 for _ in remaining)
+                yield from ({"error": "Render process died", "details": str(e)} for _ in range(failed))
+                return
+            yield result
+            for page_num in islice(remaining, 1):
+                pending.append(submit(page_num))
+    finally:
+        # The client went away; don't render pages nobody will read
+        for future in pending:
+            future.cancel()
+
+def page_results(pdf_path: str, digest: str, page_nums: List[int], settings: QualitySettings) -> Iterator[bytes]:
+    """Render the given pages in parallel, yielding each as a serialized JSON object.
+
+    Headers are already sent by then, so a failed page is reported in its own entry.
+    """
+    try:
+        pages = render_pages(pdf_path, digest, page_nums, settings)
+        for page_num, result in zip(page_nums, pages):
+            result.pop("total_pages", None)
+            result["page"] = page_num
+            yield orjson.dumps(result)
+            del result
+    
+    finally:
         force_cleanup()
-        end_memory = get_memory_usage_mb()
-        logger.info(f"Completed page {page_num}. Memory change: {end_memory - start_memory:.1f}MB")
 
-@app.route('/convert/<int:page_num>', methods=['POST'])
-def handle_convert_page(page_num):
+def stream_all_pages(pdf_path: str, digest: str, total_pages: int, settings: QualitySettings) -> Iterator[bytes]:
+    """The /convert body: every page in one JSON array"""
+    yield b'{"total_pages":%d,"pages":[' % total_pages
+    # Separators go out as their own chunks rather than copying each page to prepend them
+    for index, page in enumerate(page_results(pdf_path, digest, list(range(total_pages)), settings)):
+        if index:
+            yield b","
+        yield page
+    yield b"]}"
+
+def json_response(payload: Dict) -> Response:
+    """JSON response via orjson, which scans long base64 strings far faster than json"""
+    return app.response_class(orjson.dumps(payload), mimetype='application/json')
+
+def page_json_response(result: Dict) -> Response:
+    """JSON response for a rendered page, base64-encoding the raw image chunk by chunk.
+
+    Only one encoded chunk is held at a time, rather than the whole base64
+    string plus the serialized body that embeds it.
+    """
+    image = memoryview(result["image"])
+    head = b'{"image":"'
+    # The rest of the page fields, spliced in after the image string
+    tail = b'",' + orjson.dumps({key: value for key, value in result.items() if key != "image"})[1:]
+    
+    def generate() -> Iterator[bytes]:
+        yield head
+        for offset in range(0, len(image), BASE64_CHUNK_SIZE):
+            yield pybase64.b64encode(image[offset:offset + BASE64_CHUNK_SIZE])
+        yield tail
+    
+    content_length = len(head) + 4 * -(-len(image) // 3) + len(tail)
+    return app.response_class(generate(), mimetype='application/json',
+                              headers={"Content-Length": str(content_length)})
+
+def get_output_format() -> str:
+    # AUTO picks JPEG or PNG per page; clients can force either, or ask for WEBP
+    output_format = request.args.get('format', 'auto').upper()
+    return FORMAT_ALIASES.get(output_format, output_format)
+
+def get_dpi() -> Optional[int]:
+    """Requested render DPI clamped to [MIN_DPI, MAX_DPI], or None if not a number"""
+    try:
+        dpi = int(request.args.get('dpi', QualitySettings.dpi))
+    except ValueError:
+        return None
+    return min(max(dpi, MIN_DPI), MAX_DPI)
+
+def get_quality_settings() -> QualitySettings:
+    return QualitySettings(dpi=get_dpi(), format=get_output_format(),
+                           grayscale=request.args.get('grayscale') == '1')
+
+def validate_upload() -> Optional[Tuple]:
+    """Check that the request carries a PDF upload"""
     if 'file' not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
+        return json_response({"error": "No file uploaded"}), 400
     
     file = request.files['file']
     if not file or file.filename == '':
-        return jsonify({"error": "Invalid file"}), 400
+        return json_response({"error": "Invalid file"}), 400
+    
+    return None
+
+def validate_convert_request() -> Optional[Tuple]:
+    """Check the upload and query string shared by the convert endpoints"""
+    error = validate_upload()
+    if error:
+        return error
+    
+    if get_output_format() not in SUPPORTED_FORMATS:
+        return json_response({
+            "error": "Unsupported format",
+            "details": f"Expected one of: {', '.join(sorted(SUPPORTED_FORMATS))}"
+        }), 400
+    
+    if get_dpi() is None:
+        return json_response({
+            "error": "Invalid dpi",
+            "details": f"Expected a whole number; values are clamped to {MIN_DPI}-{MAX_DPI}"
+        }), 400
+    
+    return None
+
+def get_pdf_upload() -> Tuple[Optional[str], Optional[str], Optional[Tuple]]:
+    """Path and content digest of the uploaded PDF, spooled by SpoolToDiskRequest.
+
+    Returns an error response instead if the file is not a PDF or is too large.
+    """
+    pdf_file = request.files['file'].stream
+    
+    # Reject garbage before MuPDF spends time in its repair paths trying to parse it
+    head = pdf_file.read(UPLOAD_CHUNK_SIZE)
+    if PDF_MAGIC not in head[:PDF_HEADER_SEARCH]:
+        return None, None, (json_response({
+            "error": "Not a PDF",
+            "details": "The uploaded file has no %PDF- header"
+        }), 400)
+    
+    # BLAKE2b is several times faster than SHA-256 and plenty for a cache key.
+    # Werkzeug has only just written the file, so this reads it back from the page cache.
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(head)
+    for chunk in iter(partial(pdf_file.read, UPLOAD_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+    
+    file_size_mb = pdf_file.tell() / (1024 * 1024)
+    logger.info(f"Received PDF file. Size: {file_size_mb:.1f}MB")
+    
+    if file_size_mb > MAX_UPLOAD_MB:
+        return None, None, (json_response({
+            "error": "File too large",
+            "details": f"File size ({file_size_mb:.1f}MB) exceeds {MAX_UPLOAD_MB}MB limit"
+        }), 413)
+    
+    return pdf_file.name, hasher.hexdigest(), None
+
+def conversion_failed(e: Exception) -> Tuple:
+    """Log an unexpected conversion error and build the 500 response"""
+    logger.error(f"Conversion error: {str(e)}")
+    logger.error(f"Traceback: {traceback.format_exc()}")
+    return json_response({
+        "error": "PDF processing failed",
+        "details": str(e)
+    }), 500
+
+@app.route('/convert', methods=['POST'])
+def handle_convert():
+    error = validate_convert_request()
+    if error:
+        return error
     
     try:
-        # Read file data
-        pdf_data = file.read()
-        file_size_mb = len(pdf_data) / (1024 * 1024)
-        logger.info(f"Received PDF file. Size: {file_size_mb:.1f}MB")
+        pdf_path, digest, error = get_pdf_upload()
+        if error:
+            return error
+        
+        total_pages = document_cache.page_count(digest, pdf_path)
         
-        if file_size_mb > 30:
-            return jsonify({
-                "error": "File too large",
-                "details": f"File size ({file_size_mb:.1f}MB) exceeds 30MB limit"
-            }), 413
+        # Stream page by page; at most RENDER_WINDOW rendered pages wait on the
+        # client at a time (one when rendering in-process). Keeping the request context open keeps the upload on disk until the end.
+        return Response(
+            stream_with_context(stream_all_pages(pdf_path, digest, total_pages, get_quality_settings())),
+            mimetype='application/json'
+        )
+        
+    except Exception as e:
+        return conversion_failed(e)
+
+@app.route('/page_count', methods=['POST'])
+def handle_page_count():
+    """Page count of an upload without rendering anything.
+
+    Also warms the document cache for the page requests that usually follow.
+    """
+    error = validate_upload()
+    if error:
+        return error
+    
+    try:
+        pdf_path, digest, error = get_pdf_upload()
+        if error:
+            return error
         
-        result = process_single_page(pdf_data, page_num)
+        return json_response({"total_pages": document_cache.page_count(digest, pdf_path)})
         
+    except Exception as e:
+        return conversion_failed(e)
+
+def convert_uploaded_page(page_num: int) -> Tuple[Optional[Dict], Optional[str], Optional[Response]]:
+    """Render one page of the upload, reusing earlier renders of it.
+
+    Returns the page result with the image as raw bytes plus its ETag, or a
+    response to send instead: an error, or 304 if the client has the page.
+    """
+    settings = get_quality_settings()
+    
+    pdf_path, digest, error = get_pdf_upload()
+    if error:
+        return None, None, error
+    
+    # The same upload, page and settings always render to the same image
+    etag = f"{digest}-{page_num}-{settings.format}-{settings.dpi}-{int(settings.grayscale)}"
+    if request.if_none_match.contains(etag):
+        not_modified = Response(status=304)
+        not_modified.set_etag(etag)
+        return None, None, not_modified
+    
+    result = render_cache.get(etag)
+    if result is None:
+        with document_cache.lock:
+            result = process_single_page(pdf_path, page_num, settings, digest, encode=False)
         if "error" in result:
-            return jsonify(result), 500
+            return None, None, (json_response(result), 500)
+        render_cache.put(etag, result)
+    
+    return result, etag, None
+
+def get_batch_pages() -> Optional[List[range]]:
+    """Page ranges from the `pages` form field, e.g. "0,2,5-9", or None if malformed"""
+    page_ranges = []
+    try:
+        for part in request.form.get('pages', '').split(','):
+            if not part.strip():
+                continue
+            start, dash, end = part.partition('-')
+            start = int(start)
+            # An open-ended "5-" is malformed, not page 5
+            end = int(end) if dash else start
+            if start < 0 or end < start:
+                return None
+            # Kept as ranges so a huge span is rejected before it is expanded
+            page_ranges.append(range(start, end + 1))
+    except ValueError:
+        return None
+    return page_ranges or None
+
+def stream_batch_pages(pdf_path: str, digest: str, page_nums: List[int],
+                       settings: QualitySettings) -> Iterator[bytes]:
+    """The /convert_batch body: one NDJSON line per page"""
+    for page in page_results(pdf_path, digest, page_nums, settings):
+        yield page
+        yield b"\n"
+
+@app.route('/convert_batch', methods=['POST'])
+def handle_convert_batch():
+    """Render several pages of one upload as NDJSON, parsing the document once per render process"""
+    error = validate_convert_request()
+    if error:
+        return error
+    
+    page_ranges = get_batch_pages()
+    if page_ranges is None:
+        return json_response({
+            "error": "Invalid pages",
+            "details": "Expected comma-separated page numbers or ranges, e.g. pages=0,2,5-9"
+        }), 400
+    
+    try:
+        pdf_path, digest, error = get_pdf_upload()
+        if error:
+            return error
+        
+        total_pages = document_cache.page_count(digest, pdf_path)
+        
+        # Check up front; once streaming starts the status code is already sent
+        if max(page_range.stop for page_range in page_ranges) > total_pages:
+            return json_response({
+                "error": f"Page number exceeds document length ({total_pages} pages)",
+                "total_pages": total_pages
+            }), 400
         
-        return jsonify(result)
+        page_nums = [page_num for page_range in page_ranges for page_num in page_range]
+        return Response(
+            stream_with_context(stream_batch_pages(pdf_path, digest, page_nums, get_quality_settings())),
+            mimetype='application/x-ndjson',
+            headers={"X-Total-Pages": str(total_pages)}
+        )
         
     except Exception as e:
-        logger.error(f"Conversion error: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return jsonify({
-            "error": "PDF processing failed",
-            "details": str(e)
-        }), 500
+        return conversion_failed(e)
+
+@app.route('/convert/<int:page_num>', methods=['POST'])
+def handle_convert_page(page_num):
+    error = validate_convert_request()
+    if error:
+        return error
+    
+    try:
+        result, etag, error = convert_uploaded_page(page_num)
+        if error:
+            return error
+        
+        response = page_json_response(result)
+        response.set_etag(etag)
+        return response
+        
+    except Exception as e:
+        return conversion_failed(e)
     
     finally:
         force_cleanup()
 
-if __name__ == "__main__":
-    # Set process-wide memory limit
-    limit_memory(512)  # 512MB limit
+@app.route('/convert/<int:page_num>/raw', methods=['POST'])
+def handle_convert_page_raw(page_num):
+    """Like /convert/<page_num>, but responds with the image itself instead of base64 JSON"""
+    error = validate_convert_request()
+    if error:
+        return error
+    
+    try:
+        result, etag, error = convert_uploaded_page(page_num)
+        if error:
+            return error
+        
+        response = Response(
+            result["image"],
+            mimetype=result["mime_type"],
+            headers={
+                "X-Total-Pages": str(result["total_pages"]),
+                "X-Width": str(result["page_dimensions"]["width"]),
+                "X-Height": str(result["page_dimensions"]["height"]),
+                "X-DPI": str(result["settings_used"]["dpi"])
+            }
+        )
+        response.set_etag(etag)
+        return response
+        
+    except Exception as e:
+        return conversion_failed(e)
     
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    finally:
+        force_cleanup()
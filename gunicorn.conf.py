@@ -0,0 +1,30 @@
+import multiprocessing
+import os
+
+# One worker per core up to 4; Heroku sets WEB_CONCURRENCY to suit the dyno's memory
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+# Threads overlap upload I/O; MuPDF access is serialised by app.document_cache.lock,
+# so extra threads only cost a blocked stack while a slow client is still uploading
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# Import fitz/numpy once in the master so forked workers share it copy-on-write
+preload_app = True
+
+timeout = 300
+graceful_timeout = 30
+keepalive = 2
+
+# Recycle workers to bound memory growth: MuPDF's allocations fragment the heap
+# and are only fully returned to the OS when the process exits
+max_requests = int(os.environ.get("MAX_REQUESTS", 100))
+max_requests_jitter = max_requests // 2
+
+worker_tmp_dir = "/dev/shm"
+limit_request_line = 8192
+limit_request_field_size = 1000
+
+loglevel = "debug"
+accesslog = "-"
+errorlog = "-"
+capture_output = True
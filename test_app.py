@@ -0,0 +1,58 @@
+import numpy as np
+import orjson
+import pybase64
+import pytest
+
+from app import BASE64_CHUNK_SIZE, app, get_batch_pages, is_line_art, page_json_response
+
+# Empty, one and two bytes past a whole base64 group, and the same across chunk boundaries
+IMAGE_SIZES = [0, 1, 2, 3, BASE64_CHUNK_SIZE, BASE64_CHUNK_SIZE + 1, BASE64_CHUNK_SIZE + 2,
+               2 * BASE64_CHUNK_SIZE + 4]
+
+
+@pytest.mark.parametrize("size", IMAGE_SIZES)
+def test_page_json_response_content_length_matches_body(size):
+    image = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    response = page_json_response({"image": image, "total_pages": 1, "mime_type": "image/png"})
+    body = response.get_data()
+    assert int(response.headers["Content-Length"]) == len(body)
+    page = orjson.loads(body)
+    assert pybase64.b64decode(page["image"]) == image
+    assert page["total_pages"] == 1
+
+
+@pytest.mark.parametrize("pages, expected", [
+    ("0", [range(0, 1)]),
+    ("0,2,5-9", [range(0, 1), range(2, 3), range(5, 10)]),
+    (" 1 , 3 - 4 ", [range(1, 2), range(3, 5)]),
+    ("1,,2", [range(1, 2), range(2, 3)]),
+])
+def test_batch_pages_parses_lists_and_ranges(pages, expected):
+    with app.test_request_context(method="POST", data={"pages": pages}):
+        assert get_batch_pages() == expected
+
+
+@pytest.mark.parametrize("pages", ["", " ", ",", "-5", "5-2", "5-", "1-2-3", "a", "1.5"])
+def test_batch_pages_rejects_malformed_input(pages):
+    with app.test_request_context(method="POST", data={"pages": pages}):
+        assert get_batch_pages() is None
+
+
+def flat_page(channels):
+    """A white page with ruled lines and a few filled boxes, like a form or diagram"""
+    page = np.full((900, 1200, channels), 255, dtype=np.uint8)
+    page[::30] = 0
+    page[100:300, 100:400] = 200
+    page[500:700, 600:1000] = 90
+    return page
+
+
+@pytest.mark.parametrize("channels", [1, 3])
+def test_flat_page_is_line_art(channels):
+    assert is_line_art(flat_page(channels))
+
+
+@pytest.mark.parametrize("channels", [1, 3])
+def test_noise_page_is_not_line_art(channels):
+    noise = np.random.default_rng(0).integers(0, 256, (900, 1200, channels), dtype=np.uint8)
+    assert not is_line_art(noise)
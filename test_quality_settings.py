@@ -0,0 +1,17 @@
+from app import MAX_DPI, MIN_DPI, QualitySettings
+
+# Letter, A4, both landscape, a tall receipt and a large poster, in points
+PAGE_SIZES = [(612, 792), (595, 842), (792, 612), (842, 595), (226, 2000), (2592, 3456)]
+
+
+def test_output_never_shrinks_as_dpi_rises():
+    for width, height in PAGE_SIZES:
+        sizes = [
+            round(width * QualitySettings(dpi=dpi).render_scale(width, height))
+            for dpi in range(MIN_DPI, MAX_DPI + 1)
+        ]
+        assert sizes == sorted(sizes), (width, height)
+
+
+def test_default_dpi_renders_at_whole_zoom():
+    assert QualitySettings().render_scale(612, 792) == 2